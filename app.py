@@ -54,36 +54,44 @@ with gr.Blocks(css=css_content, theme=gr.themes.Soft(primary_hue="blue", neutral
 
     # ----------------- Query Handler -----------------
     def ask_wrapper(files, query_text, history, persistent):
-        # Run RAG QA
-        response, _, _ = retriever_qa(
+        history = history or []
+
+        # Run RAG QA, re-rendering the chat as tokens stream in
+        for response, _, _ in retriever_qa(
             files,
             query_text,
             state.value,
             persistent_memory=persistent
-        )
-
-        if response is None:
-            return history, query_text # Warning already shown in logic.py
+        ):
+            if response is None:
+                yield history, query_text # Warning already shown in logic.py
+                return
 
-        history = history or []
-
-        # Append messages as plain text tuples (user_msg, ai_msg)
-        history.append((query_text, response))
+            # Append messages as plain text tuples (user_msg, ai_msg)
+            yield history + [(query_text, response)], ""  # Clear input after sending
 
         last_query.value = query_text
-        return history, ""  # Clear input after sending
 
     # ----------------- Button Events -----------------
     ask_btn.click(
         ask_wrapper,
         inputs=[files, query_input, chatbot, persistent_checkbox],
-        outputs=[chatbot, query_input]
+        outputs=[chatbot, query_input],
+        queue=True
     )
 
     retry_btn.click(
         ask_wrapper,
         inputs=[files, last_query, chatbot, persistent_checkbox],
-        outputs=[chatbot, query_input]
+        outputs=[chatbot, query_input],
+        queue=True
     )
 
-rag_app.launch()
+# Streaming needs the queue; keep one request at a time since state.value
+# (session_id) and the retriever/memory caches are shared across users.
+rag_app.queue(default_concurrency_limit=1)
+
+# Guarded so PDF worker processes started via spawn/forkserver, which
+# re-import the main module, don't each launch their own server.
+if __name__ == "__main__":
+    rag_app.launch()
@@ -1,28 +1,103 @@
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import gradio as gr
+import atexit
+import queue
 import uuid
 import time
 import os
+import re
+import threading
+import xxhash
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from langchain_core.documents import Document
 
-# Configure logging with proper timestamps and formatting
+# Configure logging with proper timestamps and formatting.
+# Request threads only enqueue records; a background listener does the I/O.
 LOG_FILE = "rag_bot.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[
-        logging.FileHandler(LOG_FILE, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
+_log_formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
 )
+_file_handler = logging.FileHandler(LOG_FILE, encoding='utf-8')
+_stream_handler = logging.StreamHandler()
+for _h in (_file_handler, _stream_handler):
+    _h.setFormatter(_log_formatter)
+
+_log_queue = queue.Queue(-1)
+_log_listener = QueueListener(_log_queue, _file_handler, _stream_handler, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# Not basicConfig: it would give the QueueHandler a default formatter, and
+# prepare() would bake that text into the message before the listener's
+# handlers format it again.
+_root_logger = logging.getLogger()
+_root_logger.addHandler(QueueHandler(_log_queue))
+_root_logger.setLevel(logging.INFO)
 logger = logging.getLogger("RAG-Logic")
 
 # Import your PDF loader, vector store retriever, and LLM prompt logic
-from pdf_loader import document_loader, split_text
-from vector_store import get_retriever, is_namespace_populated, RETRIEVER_CACHE
+from pdf_loader import MP_CONTEXT, init_worker, load_and_split
+from vector_store import get_embedding_model, get_retriever, index_chunk_batches, is_namespace_populated, RETRIEVER_CACHE
 from qa_chain import get_llm, prompt, build_context_and_citations
 from memory_manager import wrap_chain_with_memory, save_persistent_memory
 
+# PDF worker processes log through a multiprocessing queue drained here
+_worker_log_queue = MP_CONTEXT.Queue(-1)
+_worker_log_listener = QueueListener(_worker_log_queue, _file_handler, _stream_handler, respect_handler_level=True)
+_worker_log_listener.start()
+atexit.register(_worker_log_listener.stop)
+
+
+# ----------------- Warmup -----------------
+def _warmup():
+    """Load the embedding model and build the LLM client off the request path."""
+    try:
+        start = time.time()
+        get_embedding_model().embed_query("warmup")
+        get_llm()  # client construction only; invoking would be a billed request
+        logger.info(f"Warmup finished in {time.time() - start:.2f}s")
+    except Exception as e:
+        logger.warning(f"Warmup failed (first query will initialize instead): {e}")
+
+# Opt in with RAG_WARMUP=1
+if os.getenv("RAG_WARMUP", "0") == "1":
+    threading.Thread(target=_warmup, name="warmup", daemon=True).start()
+
+# Queries mentioning these get a Sources & Citations footer.
+# Compiled into one alternation so a single scan keeps the original
+# substring semantics ("prices", "costs", "contracts" all still match).
+_CITATION_KEYWORDS = (
+    "policy", "refund", "price", "cost", "services",
+    "terms", "scope", "contract", "what does", "list"
+)
+_CITATION_RE = re.compile("|".join(map(re.escape, _CITATION_KEYWORDS)))
+
+# (path, mtime, size) -> content hash, so retries don't rescan the same file.
+# LRU-capped: every Gradio upload gets a fresh temp path, so old keys go stale.
+FILE_HASH_CACHE_SIZE = 256
+_FILE_HASH_CACHE = OrderedDict()
+
+
+def _file_hash(path):
+    """Streamed xxh3 hash of a file's bytes."""
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    if key in _FILE_HASH_CACHE:
+        _FILE_HASH_CACHE.move_to_end(key)
+        return _FILE_HASH_CACHE[key]
+
+    h = xxhash.xxh3_64()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    _FILE_HASH_CACHE[key] = h.hexdigest()
+    while len(_FILE_HASH_CACHE) > FILE_HASH_CACHE_SIZE:
+        _FILE_HASH_CACHE.popitem(last=False)
+    return _FILE_HASH_CACHE[key]
+
 
 # ----------------- Main QA Function -----------------
 def retriever_qa(files, query, state, persistent_memory=False):
@@ -32,6 +107,8 @@ def retriever_qa(files, query, state, persistent_memory=False):
     - Multi-PDF input
     - Persistent memory
     - Context + citations
+    - Token streaming: this is a generator yielding (partial_response, state, query)
+      as the LLM produces tokens; the last item carries the final response.
     """
     start_total = time.time()
     
@@ -39,31 +116,36 @@ def retriever_qa(files, query, state, persistent_memory=False):
     if not files:
         logger.warning("Validation failed: No files uploaded.")
         gr.Warning("Upload at least one PDF.")
-        return None, state, ""
+        yield None, state, ""
+        return
     if not query.strip():
         logger.warning("Validation failed: Empty query.")
         gr.Warning("Ask a question.")
-        return None, state, ""
+        yield None, state, ""
+        return
     if len(query) > 5000:
         logger.warning(f"Validation failed: Query too long ({len(query)} chars).")
         gr.Warning("Question too long (max 5000 characters).")
-        return None, state, ""
+        yield None, state, ""
+        return
 
     try:
         # --- Prepare namespace based on file content ---
-        # Generate a unique namespace hash based on the file names/paths.
+        # Generate a unique namespace hash based on the file bytes.
         # This ensures that if the file set changes, we get a new namespace
-        # and trigger a new indexing process.
+        # and trigger a new indexing process, while re-uploads of the same
+        # PDFs (any name or temp path) reuse the existing one.
         if not files:
              # Should be caught by validation above, but safe fallback
-             return None, state, ""
+             yield None, state, ""
+             return
              
         # Create a stable identifier for the set of files
-        import hashlib
-        file_identifiers = sorted([getattr(f, "name", str(f)) for f in files])
-        files_string = "".join(file_identifiers)
-        namespace = hashlib.md5(files_string.encode()).hexdigest()
-        logger.info(f"Generated namespace hash: {namespace} for files: {file_identifiers}")
+        paths = [getattr(f, "name", str(f)) for f in files]
+        hashes = [_file_hash(p) for p in paths]
+        files_string = "|".join(sorted(hashes))
+        namespace = xxhash.xxh3_64(files_string.encode()).hexdigest()
+        logger.info(f"Generated namespace hash: {namespace} for files: {paths}")
         
         # --- Setup/Retriever Optimization ---
         start_setup = time.time()
@@ -71,7 +153,7 @@ def retriever_qa(files, query, state, persistent_memory=False):
         
         # Check cache first
         if namespace in RETRIEVER_CACHE:
-            retriever = RETRIEVER_CACHE[namespace]
+            retriever = get_retriever([], namespace)  # also refreshes its LRU position
             logger.info("Using cached retriever.")
         else:
             # Check if namespace is already populated in Pinecone
@@ -80,14 +162,25 @@ def retriever_qa(files, query, state, persistent_memory=False):
                 retriever = get_retriever([], namespace)
             else:
                 logger.info(f"Namespace {namespace} empty. Processing PDFs...")
-                all_chunks = []
-                for f in files:
-                    docs = document_loader(f)       # Extract text from PDF
-                    chunks = split_text(docs)       # Split text into smaller chunks
-                    for c in chunks:
-                        c.metadata["source"] = getattr(f, "name", str(f))
-                    all_chunks.extend(chunks)
-                retriever = get_retriever(all_chunks, namespace)
+                if len(paths) == 1:
+                    # A single file isn't worth a process pool; document_loader
+                    # still fans large PDFs out over its own page pool.
+                    retriever = index_chunk_batches([load_and_split(paths[0], hashes[0])], namespace)
+                else:
+                    # Load + split each PDF in its own process; only plain paths
+                    # cross the process boundary. map() keeps submission order and
+                    # hands each file's chunks to the embed/upsert consumer as soon
+                    # as it is ready, so indexing overlaps with parsing.
+                    # Split the cores between files so nested page pools don't oversubscribe.
+                    cpus = os.cpu_count() or 1
+                    file_workers = min(len(paths), cpus)
+                    with ProcessPoolExecutor(
+                        max_workers=file_workers,
+                        mp_context=MP_CONTEXT,
+                        initializer=init_worker,
+                        initargs=(_worker_log_queue, cpus // file_workers)
+                    ) as ex:
+                        retriever = index_chunk_batches(ex.map(load_and_split, paths, hashes), namespace)
         
         setup_time = time.time() - start_setup
 
@@ -97,10 +190,26 @@ def retriever_qa(files, query, state, persistent_memory=False):
         search_time = time.time() - start_search
         
         if not docs:
-            return "No relevant information found.", state, query
+            yield "No relevant information found.", state, query
+            return
+
+        # The namespace is content-addressed, so stored chunks may carry the
+        # path of an earlier upload of the same bytes; cite the current one.
+        current_paths = dict(zip(hashes, paths))
+        docs = [
+            Document(
+                page_content=d.page_content,
+                metadata={**d.metadata, "source": current_paths[d.metadata["file_hash"]]}
+            ) if d.metadata.get("file_hash") in current_paths else d
+            for d in docs
+        ]
+
+        # --- Decide on citations up front so unused footnotes aren't built ---
+        # TODO: Switch to dynamic detection with a classifier LLM
+        show_citations = _CITATION_RE.search(query.lower()) is not None
 
         # --- Build context + citations from retrieved chunks ---
-        context_text, citations = build_context_and_citations(docs)
+        context_text, citations = build_context_and_citations(docs, with_citations=show_citations)
 
         # --- LLM Optimization & Inference ---
         start_llm = time.time()
@@ -119,38 +228,36 @@ def retriever_qa(files, query, state, persistent_memory=False):
             persistent=persistent_memory
         )
 
-        # --- Run the chain, passing session_id for memory tracking ---
-        response_obj = chain_with_memory.invoke(
+        # --- Stream the chain, passing session_id for memory tracking ---
+        response = ""
+        first_token_time = None
+        for chunk in chain_with_memory.stream(
             {"question": query, "context": context_text},
             {"configurable": {"session_id": session_id}}
-        )
+        ):
+            if first_token_time is None:
+                first_token_time = time.time() - start_llm
+            response += chunk.content
+            yield response, state, query
 
-        response = response_obj.content
         llm_time = time.time() - start_llm
 
         # --- Logging Performance Metrics ---
         total_time = time.time() - start_total
-        logger.info(f"PERF | Setup: {setup_time:.2f}s | Search: {search_time:.2f}s | LLM: {llm_time:.2f}s | Total: {total_time:.2f}s")
+        logger.info(f"PERF | Setup: {setup_time:.2f}s | Search: {search_time:.2f}s | LLM TTFT: {first_token_time or llm_time:.2f}s | LLM: {llm_time:.2f}s | Total: {total_time:.2f}s")
 
         # --- Save persistent memory if enabled ---
         if persistent_memory:
             save_persistent_memory(session_id, query, response)
 
         # --- Combine response with citations for output ---
-
-        # TODO: Switch to dynamic detection with a classifier LLM
-        show_citations = any(word in query.lower() for word in [
-        "policy", "refund", "price", "cost", "services",
-        "terms", "scope", "contract", "what does", "list"
-    ])
-      
         if show_citations:
            final_response = response + "\n\n📎 **Sources & Citations**\n" + citations
         else:
            final_response = response
 
-        return final_response, state, query
+        yield final_response, state, query
 
     except Exception as e:
         logger.error(f"Error in QA: {e}", exc_info=True)
-        return f"Error processing request: {e}", state, query
+        yield f"Error processing request: {e}", state, query
@@ -1,62 +1,96 @@
 from langchain_community.chat_message_histories import ChatMessageHistory
+from langchain_core.messages import AIMessage, HumanMessage
 from langchain_core.runnables.history import RunnableWithMessageHistory
 
+import atexit
 import uuid
 import json
+import logging
 import os
+import queue
+import threading
 
-PERSISTENT_MEMORY_FILE = "persistent_chat_memory.json"
+PERSISTENT_MEMORY_FILE = "persistent_chat_memory.jsonl"  # append-only, one exchange per line
+LEGACY_MEMORY_FILE = "persistent_chat_memory.json"      # old whole-file JSON store, read-only
 SESSION_STORE = {}  # in-memory runtime chat histories
+MAX_TURNS = 20  # user/bot exchanges replayed into the prompt
+_PERSISTENT_STORE = None  # session_id -> [{"user", "bot"}], built once from disk
+_WRITE_Q = queue.Queue()  # JSONL lines waiting for the writer thread
+_STOP = object()
 
 
-def load_persistent_store():
-    """Load persistent JSON memory store safely."""
-    if not os.path.exists(PERSISTENT_MEMORY_FILE):
+def _load_legacy_store():
+    """Read the old single-document JSON store, if present."""
+    if not os.path.exists(LEGACY_MEMORY_FILE):
         return {}
 
     try:
-        with open(PERSISTENT_MEMORY_FILE, "r", encoding="utf-8") as f:
+        with open(LEGACY_MEMORY_FILE, "r", encoding="utf-8") as f:
             content = f.read().strip()
-            if not content:
-                return {}
-            return json.loads(content)
+            return json.loads(content) if content else {}
     except Exception:
-        # corrupted JSON file → reset
+        # corrupted JSON file → ignore
         return {}
 
 
-def save_persistent_store(data):
-    """Write persistent JSON memory store."""
-    with open(PERSISTENT_MEMORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+def load_persistent_store():
+    """
+    Load persistent memory once per process: legacy JSON first, then replay
+    the JSONL log on top. Later calls return the in-memory copy.
+    """
+    global _PERSISTENT_STORE
+    if _PERSISTENT_STORE is not None:
+        return _PERSISTENT_STORE
+
+    data = _load_legacy_store()
+    if os.path.exists(PERSISTENT_MEMORY_FILE):
+        with open(PERSISTENT_MEMORY_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # partially written / corrupted line → skip
+                    continue
+                if not isinstance(rec, dict) or "session_id" not in rec:
+                    # valid JSON but not an exchange record → skip
+                    continue
+                data.setdefault(rec["session_id"], []).append(
+                    {"user": rec.get("user", ""), "bot": rec.get("bot", "")}
+                )
+
+    _PERSISTENT_STORE = data
+    return _PERSISTENT_STORE
 
 
 def get_session_history(session_id: str, persistent=False):
     """
     Returns ChatMessageHistory for session.
     Supports both runtime-only and persistent modes.
+    Only the last MAX_TURNS exchanges are kept, bounding prompt length.
     """
     global SESSION_STORE
 
     if persistent:
         data = load_persistent_store()
-        if session_id not in data:
-            data[session_id] = []
-            save_persistent_store(data)
 
         # hydrate runtime memory if not already loaded
         if session_id not in SESSION_STORE:
-            history = ChatMessageHistory()
-            for item in data[session_id]:
-                history.add_user_message(item.get("user", ""))
-                history.add_ai_message(item.get("bot", ""))
-            SESSION_STORE[session_id] = history
+            messages = []
+            for item in data.get(session_id, [])[-MAX_TURNS:]:
+                messages.append(HumanMessage(content=item.get("user", "")))
+                messages.append(AIMessage(content=item.get("bot", "")))
+            SESSION_STORE[session_id] = ChatMessageHistory(messages=messages)
 
     # non-persistent → runtime-only memory
     if session_id not in SESSION_STORE:
         SESSION_STORE[session_id] = ChatMessageHistory()
 
-    return SESSION_STORE[session_id]
+    # slide the window before the history is replayed into the prompt
+    history = SESSION_STORE[session_id]
+    if len(history.messages) > 2 * MAX_TURNS:
+        history.messages = history.messages[-2 * MAX_TURNS:]
+
+    return history
 
 
 def wrap_chain_with_memory(chain, session_id=None, persistent=False):
@@ -80,12 +114,49 @@ def wrap_chain_with_memory(chain, session_id=None, persistent=False):
     return runnable, session_id
 
 
+def _writer_loop():
+    """
+    Drain everything queued since the last wake-up and write it with a
+    single write/flush, so bursts of saves cost one disk round-trip.
+    """
+    while True:
+        lines = [_WRITE_Q.get()]
+        try:
+            while True:
+                lines.append(_WRITE_Q.get_nowait())
+        except queue.Empty:
+            pass
+
+        stop = _STOP in lines
+        lines = [l for l in lines if l is not _STOP]
+        if lines:
+            try:
+                with open(PERSISTENT_MEMORY_FILE, "a", encoding="utf-8") as f:
+                    f.write("".join(lines))
+                    f.flush()
+            except Exception as e:
+                # keep the thread alive so later saves are still written
+                logging.error(f"Failed to write {len(lines)} chat memory record(s): {e}", exc_info=True)
+        if stop:
+            return
+
+
+_writer = threading.Thread(target=_writer_loop, name="memory-writer", daemon=True)
+_writer.start()
+
+
+@atexit.register
+def _flush_writer():
+    """Write out anything still queued before the interpreter exits."""
+    _WRITE_Q.put(_STOP)
+    _writer.join(timeout=5)
+
+
 def save_persistent_memory(session_id, user_msg, bot_msg):
-    """Adds messages to persistent JSON safely."""
+    """Records one exchange in memory and queues it for the JSONL log."""
+    # load before queueing so the new line is not replayed twice
     data = load_persistent_store()
+    data.setdefault(session_id, []).append({"user": user_msg, "bot": bot_msg})
 
-    if session_id not in data:
-        data[session_id] = []
-
-    data[session_id].append({"user": user_msg, "bot": bot_msg})
-    save_persistent_store(data)
+    record = {"session_id": session_id, "user": user_msg, "bot": bot_msg}
+    _WRITE_Q.put(json.dumps(record) + "\n")
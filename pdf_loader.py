@@ -1,23 +1,118 @@
-from langchain_community.document_loaders import PyMuPDFLoader
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from logging.handlers import QueueHandler
+import fitz  # PyMuPDF
 import logging
+import math
+import multiprocessing
+import os
+
+# Below this page count the pool start-up costs more than it saves
+MIN_PAGES_FOR_POOL = 32
+
+# Fork where available: spawn/forkserver workers would re-import the app's
+# __main__ (gradio, torch, Pinecone client) before doing any PDF work.
+MP_CONTEXT = multiprocessing.get_context(
+    "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+)
+
+# Page-extraction worker budget handed down by init_worker when this process
+# is itself a per-file pool worker; None in the main process.
+_page_worker_budget = None
+
+
+def init_worker(log_queue, page_workers=1):
+    """
+    ProcessPoolExecutor initializer for PDF workers. Replaces the inherited
+    root handlers (which feed the parent's in-process queue that nothing
+    drains here, and whose lock may have been held at fork) with one that
+    ships records to the parent over a multiprocessing queue.
+    page_workers caps the nested page pool so outer and inner pools
+    together stay near the core count.
+    """
+    global _page_worker_budget
+    _page_worker_budget = max(1, page_workers)
+
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+
+
+def _get_max_workers():
+    """Number of page-extraction workers (capped by PDF_LOADER_WORKERS if set)."""
+    workers = _page_worker_budget if _page_worker_budget is not None else (os.cpu_count() or 1)
+    env = os.getenv("PDF_LOADER_WORKERS")
+    if env and env.isdigit() and int(env) > 0:
+        workers = min(workers, int(env))
+    return workers
+
+
+def _extract_page_block(path, start, end):
+    """Worker: reopen the PDF and extract text for pages [start, end)."""
+    with fitz.open(path) as doc:
+        return start, [doc[i].get_text("text") for i in range(start, end)]
+
 
 def document_loader(file):
     path = file.name if hasattr(file, 'name') else file
     logging.info(f"Loading PDF from: {path}")
     try:
-        loader = PyMuPDFLoader(path)
-        docs = loader.load()
+        with fitz.open(path) as doc:
+            n = doc.page_count
+            workers = min(_get_max_workers(), n)
+            use_pool = n >= MIN_PAGES_FOR_POOL and workers > 1
+            if not use_pool:
+                blocks = [(0, [page.get_text("text") for page in doc])]
+
+        if use_pool:
+            # Fan out contiguous page blocks rather than single pages to cut IPC
+            size = math.ceil(n / workers)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=MP_CONTEXT) as ex:
+                futures = [
+                    ex.submit(_extract_page_block, path, start, min(start + size, n))
+                    for start in range(0, n, size)
+                ]
+                blocks = sorted(f.result() for f in futures)
+
+        docs = [
+            Document(
+                page_content=text,
+                metadata={"source": path, "file_path": path, "page": start + i, "total_pages": n}
+            )
+            for start, texts in blocks
+            for i, text in enumerate(texts)
+        ]
         logging.info(f"Loaded {len(docs)} pages.")
         return docs
     except Exception as e:
         logging.error(f"PDF parsing error for {path}: {e}", exc_info=True)
         raise ValueError(f"PDF could not be parsed: {e}")
 
-def split_text(docs, chunk_size=800, chunk_overlap=300):
-    splitter = RecursiveCharacterTextSplitter(
+@lru_cache(maxsize=8)
+def _get_splitter(chunk_size, chunk_overlap):
+    return RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
         length_function=len
     )
-    return splitter.split_documents(docs)
+
+def split_text(docs, chunk_size=800, chunk_overlap=300):
+    return _get_splitter(chunk_size, chunk_overlap).split_documents(docs)
+
+def load_and_split(path, file_hash=None):
+    """
+    Load and split a single PDF. Module-level so it can run in a worker process;
+    takes a plain path string because Gradio file objects are not picklable.
+    file_hash (content hash) is stamped so citations can be re-pointed at
+    whatever name the same bytes are uploaded under later.
+    """
+    chunks = split_text(document_loader(path))
+    for c in chunks:
+        c.metadata["source"] = path
+        if file_hash:
+            c.metadata["file_hash"] = file_hash
+    return chunks
@@ -2,6 +2,8 @@
 
 from langchain_core.prompts import PromptTemplate
 from langchain_groq import ChatGroq
+from functools import lru_cache
+from posixpath import basename as _basename
 import logging
 import os
 
@@ -9,6 +11,7 @@ import os
 # Load prompt from external file for better maintainability
 PROMPT_FILE = os.path.join(os.path.dirname(__file__), "prompts", "qa_system_prompt.txt")
 
+@lru_cache(maxsize=1)
 def load_prompt_template():
     if not os.path.exists(PROMPT_FILE):
         logging.error(f"Prompt file not found at {PROMPT_FILE}")
@@ -25,6 +28,10 @@ prompt = PromptTemplate(
 # ---------------- LLM ----------------
 _LLM_CACHE = None
 
+@lru_cache(maxsize=1)
+def _groq_key():
+    return os.getenv("GROQ_API_KEY")
+
 def get_llm():
     """
     Returns a cached Groq Chat LLM instance
@@ -33,7 +40,7 @@ def get_llm():
     if _LLM_CACHE is None:
         logging.info("Initializing Groq LLM...")
         _LLM_CACHE = ChatGroq(
-            groq_api_key=os.getenv("GROQ_API_KEY"),
+            groq_api_key=_groq_key(),
             model="llama-3.3-70b-versatile",
             temperature=0.2
         )
@@ -41,15 +48,16 @@ def get_llm():
 
 
 # ---------------- Context & Citations ---------------- 
-def build_context_and_citations(docs):
+def build_context_and_citations(docs, with_citations=True):
     """
     Build context for the LLM and generate concise, readable footnotes for each source.
+    Footnote summaries are skipped entirely when with_citations is False.
     Returns:
         context_text (str): Full context text to feed the LLM.
-        citations_str (str): Clean human-friendly citations.
+        citations_str (str): Clean human-friendly citations ("" if not requested).
     """
 
-    context_text = ""
+    excerpts = []
     footnotes = []
     seen = set()  # Prevent duplicate references
 
@@ -57,7 +65,7 @@ def build_context_and_citations(docs):
 
         # ---- Extract metadata safely ----
         source_path = d.metadata.get("source", d.metadata.get("file_path", "document"))
-        filename = source_path.split("\\")[-1].split("/")[-1]
+        filename = _basename(source_path.replace("\\", "/"))
 
         # Handle different page metadata keys safely
         raw_page = (
@@ -84,7 +92,9 @@ def build_context_and_citations(docs):
 
         # ---- Extract excerpt for context ----
         excerpt = d.page_content.replace("\n", " ").strip()
-        context_text += excerpt + "\n\n"
+        excerpts.append(excerpt)
+        if not with_citations:
+            continue
 
         # ---- Build short readable summary line ----
         parts = [s.strip() for s in excerpt.split(".") if s.strip()]
@@ -104,6 +114,9 @@ def build_context_and_citations(docs):
             f"[{len(footnotes)+1}] {filename}{label}: {summary}."
         )
 
+    # ---- Join excerpts once (each followed by a blank line) ----
+    context_text = "".join(e + "\n\n" for e in excerpts)
+
     # ---- Join nicely formatted citations ----
     citations_str = "\n".join(footnotes) if footnotes else ""
     return context_text, citations_str
@@ -1,57 +1,349 @@
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
 from langchain_pinecone import PineconeVectorStore
+# Same enum PineconeVectorStore compares against (not re-exported at package level)
+from langchain_pinecone.vectorstores import DistanceStrategy
 from pinecone import Pinecone
+from sentence_transformers import SentenceTransformer
+from collections import OrderedDict
+from uuid import uuid4
+import faiss
+import queue
+import threading
+import time
+import numpy as np
 import os, logging
 from dotenv import load_dotenv
 
 load_dotenv()
 
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_DIM = 384
+ONNX_CACHE_DIR = os.path.join(os.path.dirname(__file__), ".onnx_cache", "all-MiniLM-L6-v2-int8")
+ONNX_QUANTIZED_FILE = "model_quantized.onnx"
+EMBED_BATCH_SIZE = 64
+UPSERT_BATCH_SIZE = 100
+PIPELINE_BATCH_SIZE = 256  # chunks handed from producer to embed/upsert consumer
+PIPELINE_QUEUE_SIZE = 4
+# Corpora below this many chunks are searched in RAM with FAISS instead of Pinecone
+LOCAL_INDEX_MAX_CHUNKS = 20000
+
+RETRIEVER_CACHE = OrderedDict()  # namespace -> retriever, least recently used first
+# FAISS retrievers hold their whole corpus in RAM, so only the most recent few are kept
+LOCAL_RETRIEVER_CACHE_SIZE = 4
+_RETRIEVER_CACHE_LOCK = threading.Lock()
+
+QUERY_CACHE_SIZE = 512
+QUERY_CACHE_DECIMALS = 6
+_QUERY_CACHE = OrderedDict()  # (namespace, rounded query vector bytes, k) -> docs
+_QUERY_CACHE_LOCK = threading.Lock()
+
+STATS_TTL_SECONDS = 30
+_STATS_CACHE = {"t": 0, "data": {}}  # last describe_index_stats() namespaces
+
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 INDEX_NAME = "rag-pdf-bot"
+# Embeddings are L2-normalized, so dot product ranks exactly like cosine
+# without the server re-normalizing every vector per query.
+INDEX_METRIC = "dotproduct"
 pc = Pinecone(api_key=PINECONE_API_KEY)
 if INDEX_NAME not in [index.name for index in pc.list_indexes()]:
-    pc.create_index(name=INDEX_NAME, dimension=384, metric="cosine", spec={"serverless": {"cloud":"aws"}})
+    pc.create_index(name=INDEX_NAME, dimension=EMBED_DIM, metric=INDEX_METRIC, spec={"serverless": {"cloud":"aws"}})
+else:
+    _existing_metric = pc.describe_index(INDEX_NAME).metric
+    if _existing_metric != INDEX_METRIC:
+        # A metric cannot be changed in place; results stay correct on a cosine
+        # index since vectors are normalized. Recreate the index to migrate.
+        logging.warning(
+            f"Pinecone index '{INDEX_NAME}' uses metric '{_existing_metric}'; "
+            f"recreate it with '{INDEX_METRIC}' to skip server-side normalization."
+        )
 pc_index = pc.Index(INDEX_NAME)
 
+class MiniLMEmbeddings(Embeddings):
+    """
+    LangChain-compatible wrapper around SentenceTransformer that always
+    encodes in large, normalized batches.
+    """
+    def __init__(self, model_name=EMBED_MODEL_NAME, batch_size=EMBED_BATCH_SIZE):
+        self.model = SentenceTransformer(model_name)
+        self.batch_size = batch_size
+
+    def _embed_batched(self, texts):
+        return self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+
+    def embed_documents(self, texts):
+        return self._embed_batched(list(texts)).tolist()
+
+    def embed_query(self, text):
+        return self._embed_batched([text])[0].tolist()
+
+class QuantizedMiniLMEmbeddings(MiniLMEmbeddings):
+    """
+    MiniLM exported to ONNX and dynamically quantized to int8, run through
+    onnxruntime on CPU. The quantized model is written to ONNX_CACHE_DIR on
+    first use and loaded from there afterwards.
+    """
+    def __init__(self, model_name=EMBED_MODEL_NAME, batch_size=EMBED_BATCH_SIZE):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        if not os.path.exists(os.path.join(ONNX_CACHE_DIR, ONNX_QUANTIZED_FILE)):
+            logging.info(f"Exporting and quantizing {model_name} to {ONNX_CACHE_DIR}...")
+            fp32_model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+            quantizer = ORTQuantizer.from_pretrained(fp32_model)
+            quantizer.quantize(
+                save_dir=ONNX_CACHE_DIR,
+                quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            )
+            AutoTokenizer.from_pretrained(model_name).save_pretrained(ONNX_CACHE_DIR)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(ONNX_CACHE_DIR)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            ONNX_CACHE_DIR,
+            file_name=ONNX_QUANTIZED_FILE,
+            provider="CPUExecutionProvider"
+        )
+        self.batch_size = batch_size
+
+    def _embed_batched(self, texts):
+        out = []
+        for i in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(
+                texts[i:i + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=256,
+                return_tensors="np"
+            )
+            hidden = self.model(**inputs).last_hidden_state
+            # Mean pooling over real tokens, then L2-normalize (as sentence-transformers does)
+            mask = inputs["attention_mask"][..., None].astype(hidden.dtype)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            out.append(pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None))
+        return np.vstack(out) if out else np.empty((0, EMBED_DIM), dtype=np.float32)
+
 _embedding_model_cache = None
+_embedding_model_lock = threading.Lock()  # warmup thread and first request may race
 def get_embedding_model():
     global _embedding_model_cache
-    if _embedding_model_cache is None:
-        logging.info("Initializing embedding model...")
-        _embedding_model_cache = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    with _embedding_model_lock:
+        if _embedding_model_cache is None:
+            logging.info("Initializing embedding model...")
+            try:
+                _embedding_model_cache = QuantizedMiniLMEmbeddings()
+            except Exception as e:
+                # optimum/onnxruntime missing or export failed → plain FP32 model
+                logging.warning(f"Int8 ONNX embedding model unavailable ({e}); falling back to FP32.")
+                _embedding_model_cache = MiniLMEmbeddings()
     return _embedding_model_cache
 
-RETRIEVER_CACHE = {}
+def _upsert_chunks(chunks, namespace, embeddings=None):
+    """
+    Embed all chunks in one batched encode call (unless embeddings are
+    passed in), then upsert to Pinecone in fixed-size slices. Metadata
+    mirrors what PineconeVectorStore writes (page text under "text") so
+    the store can read the vectors back.
+    """
+    texts = [c.page_content for c in chunks]
+    if embeddings is None:
+        embeddings = get_embedding_model()._embed_batched(texts)
+    vectors = [
+        (str(uuid4()), emb.tolist(), {"text": text, **c.metadata})
+        for c, text, emb in zip(chunks, texts, embeddings)
+    ]
+    for i in range(0, len(vectors), UPSERT_BATCH_SIZE):
+        pc_index.upsert(vectors=vectors[i:i + UPSERT_BATCH_SIZE], namespace=namespace)
+    if vectors:
+        _STATS_CACHE["t"] = 0  # namespace set changed → refetch stats next time
+    logging.info(f"Upserted {len(vectors)} vectors to namespace: {namespace}")
+
+class FaissRetriever:
+    """
+    Exact in-memory inner-product search over a small corpus. Embeddings are
+    normalized, so this ranks like the Pinecone index without a network hop.
+    """
+    def __init__(self, chunks, embeddings, k=5):
+        self.index = faiss.IndexFlatIP(EMBED_DIM)
+        self.index.add(np.ascontiguousarray(embeddings, dtype=np.float32))
+        self.chunks = chunks
+        self.k = k
+
+    def invoke(self, query):
+        if not self.chunks:
+            return []
+        q = np.ascontiguousarray(get_embedding_model()._embed_batched([query]), dtype=np.float32)
+        _, ids = self.index.search(q, min(self.k, len(self.chunks)))
+        return [self.chunks[i] for i in ids[0] if i >= 0]
+
+def _cache_retriever(namespace, retriever):
+    """Store a retriever, evicting the least recently used FAISS entries over the cap."""
+    with _RETRIEVER_CACHE_LOCK:
+        RETRIEVER_CACHE[namespace] = retriever
+        RETRIEVER_CACHE.move_to_end(namespace)
+        local = [ns for ns, r in RETRIEVER_CACHE.items() if isinstance(r, FaissRetriever)]
+        for ns in local[:-LOCAL_RETRIEVER_CACHE_SIZE]:
+            logging.info(f"Evicting in-memory retriever for namespace: {ns}")
+            del RETRIEVER_CACHE[ns]
+
+def index_chunk_batches(chunk_batches, namespace, k=5):
+    """
+    Embed chunks on a consumer thread while the caller's iterable is still
+    producing them (e.g. PDFs still being parsed) and return a retriever.
+    Embeddings stay in memory until the corpus reaches LOCAL_INDEX_MAX_CHUNKS;
+    below that the result is a FaissRetriever, otherwise everything is
+    upserted to Pinecone, overlapping compute with network I/O.
+    On any failure the namespace is cleared so a half-indexed file set is
+    not mistaken for a populated one on the next request.
+    """
+    q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    errors = []
+    local = []  # [(chunks, embeddings)] while the corpus still fits locally
+    remote = False
+
+    def _consume():
+        nonlocal remote
+        buffered = 0
+        while True:
+            batch = q.get()
+            if batch is None:
+                return
+            if errors:
+                continue  # keep draining so the producer never blocks
+            try:
+                embeddings = get_embedding_model()._embed_batched([c.page_content for c in batch])
+                if not remote and buffered + len(batch) < LOCAL_INDEX_MAX_CHUNKS:
+                    local.append((batch, embeddings))
+                    buffered += len(batch)
+                    continue
+                if not remote:
+                    # Corpus outgrew the local index → move everything to Pinecone
+                    logging.info(f"Namespace {namespace} exceeds {LOCAL_INDEX_MAX_CHUNKS} chunks; using Pinecone.")
+                    remote = True
+                    for chunks, embs in local:
+                        _upsert_chunks(chunks, namespace, embs)
+                    local.clear()
+                _upsert_chunks(batch, namespace, embeddings)
+            except Exception as e:
+                errors.append(e)
+
+    consumer = threading.Thread(target=_consume, name=f"indexer-{namespace}", daemon=True)
+    consumer.start()
+
+    total = 0
+    try:
+        for chunks in chunk_batches:
+            for i in range(0, len(chunks), PIPELINE_BATCH_SIZE):
+                if errors:
+                    break
+                q.put(chunks[i:i + PIPELINE_BATCH_SIZE])
+            total += len(chunks)
+            if errors:
+                break
+    except Exception:
+        errors.append(None)  # stop the consumer; re-raise the producer error below
+        raise
+    finally:
+        q.put(None)
+        consumer.join()
+        if errors and remote:
+            logging.error(f"Indexing failed for namespace {namespace}; clearing partial vectors.")
+            try:
+                pc_index.delete(delete_all=True, namespace=namespace)
+            except Exception as e:
+                logging.error(f"Could not clear namespace {namespace}: {e}")
+            _STATS_CACHE["t"] = 0
+
+    if errors:
+        raise errors[0]
+
+    if remote:
+        logging.info(f"Indexed {total} chunks into Pinecone namespace: {namespace}")
+        return get_retriever([], namespace, k=k)
+
+    logging.info(f"Indexed {total} chunks in memory (FAISS) for namespace: {namespace}")
+    chunks = [c for batch, _ in local for c in batch]
+    embeddings = np.vstack([embs for _, embs in local]) if local else np.empty((0, EMBED_DIM), dtype=np.float32)
+    retriever = FaissRetriever(chunks, embeddings, k=k)
+    _cache_retriever(namespace, retriever)
+    return retriever
+
+class CachedRetriever:
+    """
+    Client-side LRU cache in front of a Pinecone top-k search. Queries are
+    keyed on their rounded embedding, so repeats (and trivially different
+    phrasings that embed identically) skip the network round-trip.
+    """
+    def __init__(self, vectordb, namespace, k=5):
+        self.vectordb = vectordb
+        self.namespace = namespace
+        self.k = k
+
+    def invoke(self, query):
+        embedding = get_embedding_model().embed_query(query)
+        sig = np.round(np.asarray(embedding, dtype=np.float32), QUERY_CACHE_DECIMALS).tobytes()
+        key = (self.namespace, sig, self.k)
+
+        with _QUERY_CACHE_LOCK:
+            if key in _QUERY_CACHE:
+                _QUERY_CACHE.move_to_end(key)
+                return list(_QUERY_CACHE[key])
+
+        docs = self.vectordb.similarity_search_by_vector(embedding, k=self.k)
+
+        with _QUERY_CACHE_LOCK:
+            _QUERY_CACHE[key] = docs
+            _QUERY_CACHE.move_to_end(key)
+            while len(_QUERY_CACHE) > QUERY_CACHE_SIZE:
+                _QUERY_CACHE.popitem(last=False)
+        return list(docs)
 
 def get_retriever(chunks, namespace, k=5):
     """
     Returns a retriever for a given namespace.
+    Small fresh corpora get an in-memory FaissRetriever; otherwise Pinecone.
     Caches the retriever in memory to avoid redundant connections.
     """
-    global RETRIEVER_CACHE
-    
-    if namespace in RETRIEVER_CACHE:
-        logging.info(f"Returning cached retriever for namespace: {namespace}")
-        return RETRIEVER_CACHE[namespace]
+    with _RETRIEVER_CACHE_LOCK:
+        if namespace in RETRIEVER_CACHE:
+            logging.info(f"Returning cached retriever for namespace: {namespace}")
+            RETRIEVER_CACHE.move_to_end(namespace)
+            return RETRIEVER_CACHE[namespace]
 
     logging.info(f"Initializing new retriever for namespace: {namespace}")
-    vectordb = PineconeVectorStore.from_documents(
-        documents=chunks,
+    if chunks:
+        # Fresh corpus → FAISS or Pinecone depending on its size
+        return index_chunk_batches([chunks], namespace, k=k)
+
+    # Namespace already indexed → just attach to it, no embedding/upsert work
+    logging.info(f"Attaching to existing namespace: {namespace}")
+    vectordb = PineconeVectorStore(
+        index=pc_index,
         embedding=get_embedding_model(),
-        index_name=INDEX_NAME,
-        namespace=namespace
+        namespace=namespace,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
     )
-    retriever = vectordb.as_retriever(search_kwargs={"k": k})
-    RETRIEVER_CACHE[namespace] = retriever
+    retriever = CachedRetriever(vectordb, namespace, k=k)
+    _cache_retriever(namespace, retriever)
     return retriever
 
 def is_namespace_populated(namespace):
     """
     Checks if a namespace exists and has vectors in Pinecone.
+    Index stats are cached for STATS_TTL_SECONDS to avoid a round-trip per call.
     """
     try:
-        stats = pc_index.describe_index_stats()
-        return namespace in stats.get("namespaces", {})
+        now = time.time()
+        if now - _STATS_CACHE["t"] > STATS_TTL_SECONDS:
+            stats = pc_index.describe_index_stats()
+            _STATS_CACHE.update(t=now, data=stats.get("namespaces", {}))
+        return namespace in _STATS_CACHE["data"]
     except Exception as e:
         logging.error(f"Error checking namespace stats: {e}")
         return False